@@ -1,24 +1,98 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import mmap
 import os
+import random
+import shutil
+import tempfile
+import threading
 import time
+import uuid
 from twelvelabs import TwelveLabs
 from dotenv import load_dotenv
 import cv2
-import base64
+import httpx
 import requests
 
+# PyAV is optional but preferred for frame extraction (accurate keyframe seeks)
+try:
+    import av
+except ImportError:
+    av = None
+
 load_dotenv()
 
 app = Flask(__name__)
 CORS(app)
 
-# Initialize Twelve Labs
-client = TwelveLabs(api_key=os.getenv("TWELVE_KEY"))
+# Have Werkzeug refuse oversized uploads before buffering them
+MAX_UPLOAD_BYTES = 500 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+
+# Initialize Twelve Labs with a generous keep-alive pool so upload, status
+# polling, analyze and search all reuse warm TLS connections instead of
+# paying a fresh handshake each call
+try:
+    client = TwelveLabs(
+        api_key=os.getenv("TWELVE_KEY"),
+        httpx_client=httpx.Client(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+        )
+    )
+except TypeError:
+    # Older SDK versions don't accept a custom httpx client
+    client = TwelveLabs(api_key=os.getenv("TWELVE_KEY"))
 
 # API Ninjas API Key
 API_NINJAS_KEY = os.getenv("API_NINJAS_KEY")
 
+# Extracted frames live in the system temp dir - unlike a process-local
+# dict, disk is shared across gunicorn workers, so /api/frame can serve a
+# frame no matter which worker handled the upload
+FRAME_DIR = tempfile.gettempdir()
+FRAME_TTL_SECONDS = 10 * 60
+
+# Videos we've already indexed, keyed by content hash. A repeat upload of
+# the same file reuses its index instead of paying minutes of indexing
+# (and TwelveLabs quota) again (sha256 -> (index_id, indexed_asset_id))
+INDEX_CACHE = {}
+
+# Deferred cleanup so the worker can send the response without waiting on
+# filesystem work
+cleanup_pool = ThreadPoolExecutor(max_workers=4)
+
+def remove_file_later(path):
+    """Queue a file for deletion off the request thread"""
+    def remove_quiet():
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    cleanup_pool.submit(remove_quiet)
+
+def hash_video_file(path):
+    """SHA-256 of the file contents via mmap - no copies into the Python heap"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size > 0:
+            # Hash straight out of the page cache; RSS stays flat even for
+            # multi-GB videos (mmap rejects empty files, hence the guard)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                sha.update(mm)
+    return sha.hexdigest()
+
+def schedule_frame_cleanup(frame_name):
+    """Delete an extracted frame after the client has had time to fetch it"""
+    frame_path = os.path.join(FRAME_DIR, frame_name)
+    def remove_quiet():
+        try:
+            os.remove(frame_path)
+        except OSError:
+            pass
+    threading.Timer(FRAME_TTL_SECONDS, remove_quiet).start()
+
 # Common car makes for quick suggestions (alphabetically sorted)
 COMMON_MAKES = [
     "Acura", "Alfa Romeo", "Aston Martin", "Audi", "Bentley", "BMW", "Buick", 
@@ -66,44 +140,128 @@ POPULAR_MODELS = {
     "Lincoln": ["Aviator", "Nautilus", "Navigator", "Corsair"],
 }
 
-def extract_high_quality_frame(video_path, timestamp_seconds):
-    """Extract a high-quality frame from video at specific timestamp"""
-    try:
-        print(f"Extracting frame from {video_path} at {timestamp_seconds}s...")
+def _open_video(video_path):
+    """Open a video once so repeated frame extractions share the demuxer"""
+    if av is not None:
+        container = av.open(video_path)
+
+        # Let FFmpeg use frame/slice threading for the decode run-up
+        container.streams.video[0].thread_type = 'AUTO'
+        return container
+
+    # OpenCV fallback: ask FFmpeg for a hardware decoder (VAAPI/NVDEC/...)
+    # when this build supports it; VIDEO_ACCELERATION_ANY falls back to
+    # software
+    if hasattr(cv2, 'CAP_PROP_HW_ACCELERATION'):
+        cap = cv2.VideoCapture(video_path, cv2.CAP_FFMPEG,
+                               [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY])
+    else:
         cap = cv2.VideoCapture(video_path)
-        
-        if not cap.isOpened():
-            print("Failed to open video file")
-            return None
-        
-        # Get video properties
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        print(f"Video: {fps} fps, {total_frames} total frames")
-        
-        # Set video position to timestamp (in milliseconds)
-        cap.set(cv2.CAP_PROP_POS_MSEC, timestamp_seconds * 1000)
-        
-        # Read the frame
-        success, frame = cap.read()
-        cap.release()
-        
-        if success and frame is not None:
-            # Save frame as high-quality JPEG (quality 95/100)
-            output_filename = f"frame_{int(time.time())}_{int(timestamp_seconds)}.jpg"
-            output_path = os.path.join(os.getcwd(), output_filename)
-            
-            # Use maximum quality settings
-            encode_params = [cv2.IMWRITE_JPEG_QUALITY, 95]
-            cv2.imwrite(output_path, frame, encode_params)
-            
-            print(f"✓ Frame extracted successfully: {output_path}")
+    return cap
+
+def _close_video(video):
+    """Release whichever handle _open_video returned"""
+    if av is not None and isinstance(video, av.container.Container):
+        video.close()
+    else:
+        video.release()
+
+def _extract_frame_pyav(container, timestamp_seconds):
+    """Grab the frame at timestamp_seconds using PyAV keyframe seek + short decode"""
+    stream = container.streams.video[0]
+
+    # Jump to the keyframe preceding the target, then decode forward
+    target_pts = int(timestamp_seconds / stream.time_base)
+    container.seek(target_pts, any_frame=False, backward=True, stream=stream)
+
+    for frame in container.decode(stream):
+        if frame.time is not None and frame.time < timestamp_seconds:
+            continue
+        return frame.to_ndarray(format='bgr24')
+
+    return None
+
+def _extract_frame_opencv(cap, timestamp_seconds):
+    """OpenCV fallback when PyAV is not installed"""
+    if not cap.isOpened():
+        print("Failed to open video file")
+        return None
+
+    # Get video properties
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    print(f"Video: {fps} fps, {total_frames} total frames")
+
+    target_frame = int(timestamp_seconds * fps) if fps > 0 else 0
+    current_frame = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+
+    # For distant targets, seek close first; for nearby ones, grabbing
+    # forward is cheaper than a coarse seek
+    if not 0 <= target_frame - current_frame <= 300:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, target_frame)
+    else:
+        # grab() skips the colorspace conversion + NumPy copy that read()
+        # pays on every intermediate frame we are going to throw away
+        for _ in range(target_frame - current_frame):
+            if not cap.grab():
+                break
+
+    # Decode only the frame we actually want
+    success = cap.grab()
+    if success:
+        success, frame = cap.retrieve()
+    else:
+        frame = None
+
+    return frame if success else None
+
+def _extract_frame(video, timestamp_seconds):
+    """Decode the frame at timestamp_seconds from an already-open video"""
+    if av is not None and isinstance(video, av.container.Container):
+        return _extract_frame_pyav(video, timestamp_seconds)
+    return _extract_frame_opencv(video, timestamp_seconds)
+
+def extract_high_quality_frame(video, timestamp_seconds):
+    """Extract a high-quality frame at a specific timestamp from an
+    already-open video (see _open_video)"""
+    try:
+        print(f"Extracting frame at {timestamp_seconds}s...")
+
+        # PyAV seeks to the preceding keyframe and decodes just a few frames,
+        # avoiding CAP_PROP_POS_MSEC's slow and inaccurate seeks on H.264/H.265
+        frame = _extract_frame(video, timestamp_seconds)
+
+        if frame is not None:
+            # Downscale to a 1280px longest edge - the UI shows a
+            # thumbnail-sized screenshot, so full resolution just wastes
+            # encode CPU and response bytes
+            h, w = frame.shape[:2]
+            scale = 1280 / max(h, w)
+            if scale < 1:
+                frame = cv2.resize(frame, None, fx=scale, fy=scale,
+                                   interpolation=cv2.INTER_AREA)
+
+            # Quality 85 + optimized tables looks the same on screen at
+            # roughly a third of the bytes of quality 95
+            encode_params = [cv2.IMWRITE_JPEG_QUALITY, 85, cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+            ok, buf = cv2.imencode('.jpg', frame, encode_params)
+            if not ok:
+                print("Failed to encode frame as JPEG")
+                return None
+
+            # The name is a client-visible key, so it must be unique across
+            # concurrent requests - time-based names can collide
+            frame_name = f"frame_{uuid.uuid4().hex}.jpg"
+            with open(os.path.join(FRAME_DIR, frame_name), 'wb') as f:
+                f.write(buf.tobytes())
+
+            print(f"✓ Frame extracted successfully: {frame_name}")
             print(f"  Frame size: {frame.shape[1]}x{frame.shape[0]}")
-            return output_path
+            return frame_name
         else:
             print("Failed to read frame from video")
             return None
-            
+
     except Exception as e:
         print(f"Error extracting frame: {e}")
         import traceback
@@ -254,6 +412,19 @@ def search_models():
             "message": str(e)
         }), 500
 
+@app.route('/api/frame/<name>', methods=['GET'])
+def get_frame(name):
+    """Serve an extracted frame from the shared temp dir"""
+    # Only serve the JPEGs we generated ourselves, no path components
+    if name != os.path.basename(name) or not name.startswith('frame_') or not name.endswith('.jpg'):
+        return jsonify({"status": "error", "message": "Invalid frame name"}), 404
+
+    frame_path = os.path.join(FRAME_DIR, name)
+    if not os.path.exists(frame_path):
+        return jsonify({"status": "error", "message": "Frame not found"}), 404
+
+    return send_file(frame_path, mimetype='image/jpeg')
+
 @app.route('/api/search', methods=['POST'])
 def search_media():
     # 1. Get Form Data from React
@@ -261,87 +432,142 @@ def search_media():
     model = request.form.get('model', 'unknown')
     color = request.form.get('color', 'unknown')
     file = request.files.get('media')
-    
-    if not file:
+
+    # Reject obviously invalid uploads up front, before any temp-file
+    # writes or TwelveLabs API work
+    if not file or not file.filename:
         return jsonify({"status": "error", "message": "No file uploaded"}), 400
 
+    if file.mimetype and not file.mimetype.startswith('video/'):
+        return jsonify({"status": "error", "message": "Uploaded file must be a video"}), 400
+
+    if request.content_length and request.content_length > MAX_UPLOAD_BYTES:
+        return jsonify({"status": "error", "message": "File too large (500 MB max)"}), 400
+
     # 2. Save file temporarily to process it
-    temp_path = os.path.join(os.getcwd(), file.filename)
-    file.save(temp_path)
-    frame_path = None
+    # A unique temp name (instead of the user-controlled filename in the
+    # working directory) keeps concurrent uploads of the same file from
+    # clobbering each other, and the system temp dir is often tmpfs.
+    # Stream with a 4 MB buffer instead of file.save()'s 16 KB default,
+    # which makes hundreds of MB of video far fewer write() syscalls
+    suffix = os.path.splitext(file.filename)[1]
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as dst:
+        temp_path = dst.name
+        shutil.copyfileobj(file.stream, dst, length=4 * 1024 * 1024)
 
     try:
-        # 3. Create Index
-        index_name = f"index_{int(time.time())}"
-        index = client.indexes.create(
-            index_name=index_name,
-            models=[
-                # Pegasus for the text analysis
-                {"model_name": "pegasus1.2", "model_options": ["visual", "audio"]},
-                # Marengo for the search/screenshot capability
-                {"model_name": "marengo2.7", "model_options": ["visual", "audio"]}
-            ]
-        )
-        print(f"Index created: {index.id}")
-
-        # 4. Upload File to Twelve Labs
-        with open(temp_path, "rb") as video_file:
-            asset = client.assets.create(method="direct", file=video_file)
-        print(f"Asset created: {asset.id}")
-
-        # 5. Index the asset
-        indexed_asset = client.indexes.indexed_assets.create(
-            index_id=index.id,
-            asset_id=asset.id,
-            enable_video_stream=True
-        )
-        print(f"Indexed asset created: {indexed_asset.id}")
+        # Re-uploads of an already-indexed video skip straight to analysis
+        video_key = hash_video_file(temp_path)
+        cached = INDEX_CACHE.get(video_key)
+
+        # Final indexed-asset object from the poll loop; its hls field is
+        # already populated once status is ready, so the thumbnail
+        # fallback doesn't need another retrieve() round trip
+        ready_asset = None
+
+        if cached:
+            index_id, indexed_asset_id = cached
+            print(f"Cache hit for video {video_key[:12]}, reusing index {index_id}")
+        else:
+            # 3+4. Create Index and upload the file in parallel - the two
+            # calls are independent I/O, so we only wait for the slower one
+            def create_index():
+                index_name = f"index_{int(time.time())}"
+                return client.indexes.create(
+                    index_name=index_name,
+                    models=[
+                        # Pegasus for the text analysis
+                        {"model_name": "pegasus1.2", "model_options": ["visual", "audio"]},
+                        # Marengo for the search/screenshot capability
+                        {"model_name": "marengo2.7", "model_options": ["visual", "audio"]}
+                    ]
+                )
+
+            def upload_asset():
+                with open(temp_path, "rb") as video_file:
+                    return client.assets.create(method="direct", file=video_file)
+
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                index_future = executor.submit(create_index)
+                asset_future = executor.submit(upload_asset)
+                index = index_future.result()
+                asset = asset_future.result()
+            print(f"Index created: {index.id}")
+            print(f"Asset created: {asset.id}")
 
-        # 6. Wait for indexing (Poll status)
-        print("Indexing in progress...")
-        while True:
-            indexed_asset = client.indexes.indexed_assets.retrieve(
+            # 5. Index the asset
+            indexed_asset = client.indexes.indexed_assets.create(
                 index_id=index.id,
-                indexed_asset_id=indexed_asset.id
+                asset_id=asset.id,
+                enable_video_stream=True
             )
-            print(f"Indexing status: {indexed_asset.status}")
-            if indexed_asset.status == "ready":
-                print("Indexing complete!")
-                break
-            elif indexed_asset.status == "failed":
-                raise Exception("Twelve Labs Indexing failed")
-            time.sleep(5)
+            print(f"Indexed asset created: {indexed_asset.id}")
+
+            # 6. Wait for indexing (Poll status with exponential backoff)
+            # Short clips finish fast, so start polling quickly; back off
+            # for long videos to avoid hammering the API
+            print("Indexing in progress...")
+            delay = 0.5
+            while True:
+                indexed_asset = client.indexes.indexed_assets.retrieve(
+                    index_id=index.id,
+                    indexed_asset_id=indexed_asset.id
+                )
+                print(f"Indexing status: {indexed_asset.status}")
+                if indexed_asset.status == "ready":
+                    print("Indexing complete!")
+                    break
+                elif indexed_asset.status == "failed":
+                    raise Exception("Twelve Labs Indexing failed")
+                time.sleep(delay + random.uniform(0, 0.1))
+                delay = min(delay * 2, 8.0)
 
-        # 7. Analyze with Twelve Labs
+            index_id = index.id
+            indexed_asset_id = indexed_asset.id
+            ready_asset = indexed_asset
+            INDEX_CACHE[video_key] = (index_id, indexed_asset_id)
+
+        # 7+8. Analyze and SEARCH in parallel - both run against the
+        # fully-indexed asset and are independent, so the total wait is
+        # max(analyze, search) instead of their sum
         prompt = f"Analyze the video completely. Is there a {color} {make} {model}?"
         print(f"Analysis prompt: {prompt}")
-        text_stream = client.analyze_stream(
-            video_id=indexed_asset.id,
-            prompt=prompt
-        )
 
-        full_response = ""
-        for text in text_stream:
-            if text.event_type == "text_generation":
-                full_response += text.text
-        print(f"Analysis complete: {full_response[:100]}...")
-
-        # 8. SEARCH for the vehicle to get the timestamp
         search_query = f"a {color} {make} {model}"
         print(f"Searching for: {search_query}")
-        
-        search_results = client.search.query(
-            index_id=index.id,
-            query_text=search_query,
-            search_options=["visual"],
-            page_limit=5
-        )
+
+        def run_analysis():
+            text_stream = client.analyze_stream(
+                video_id=indexed_asset_id,
+                prompt=prompt
+            )
+            # Collect chunks and join once instead of growing a string,
+            # which goes quadratic on long analyses
+            parts = []
+            for text in text_stream:
+                if text.event_type == "text_generation":
+                    parts.append(text.text)
+            return ''.join(parts)
+
+        def run_search():
+            return list(client.search.query(
+                index_id=index_id,
+                query_text=search_query,
+                search_options=["visual"],
+                page_limit=5
+            ))
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            analyze_future = executor.submit(run_analysis)
+            search_future = executor.submit(run_search)
+            full_response = analyze_future.result()
+        print(f"Analysis complete: {full_response[:100]}...")
 
         screenshot_url = None
         match_timestamp = None
-        
+
         try:
-            results_list = list(search_results)
+            results_list = search_future.result()
             print(f"Number of search results: {len(results_list)}")
             
             if results_list and len(results_list) > 0:
@@ -349,24 +575,39 @@ def search_media():
                 match_timestamp = first_result.start
                 print(f"Best match at timestamp: {match_timestamp}s (score: {first_result.score})")
                 
-                # 9. EXTRACT HIGH-QUALITY FRAME using OpenCV
-                frame_path = extract_high_quality_frame(temp_path, match_timestamp)
-                
-                if frame_path and os.path.exists(frame_path):
-                    # Convert to base64 to embed directly in response
-                    with open(frame_path, 'rb') as img_file:
-                        img_data = base64.b64encode(img_file.read()).decode('utf-8')
-                        screenshot_url = f"data:image/jpeg;base64,{img_data}"
-                    
-                    print("✓ High-quality frame converted to base64")
+                # 9. EXTRACT HIGH-QUALITY FRAME - open the video once and
+                # reuse the handle for however many frames we pull from it
+                frame_name = None
+                try:
+                    video = _open_video(temp_path)
+                    try:
+                        frame_name = extract_high_quality_frame(video, match_timestamp)
+                    finally:
+                        _close_video(video)
+                except Exception as e:
+                    print(f"Error opening video for extraction: {e}")
+
+                if frame_name:
+                    # Hand the client a short URL instead of a multi-MB
+                    # base64 blob: no encode CPU, ~33% less bandwidth, and
+                    # no giant string inside the JSON payload
+                    screenshot_url = f"{request.host_url.rstrip('/')}/api/frame/{frame_name}"
+                    schedule_frame_cleanup(frame_name)
+
+                    print(f"✓ High-quality frame available at {screenshot_url}")
                 else:
                     print("⚠ Failed to extract frame, falling back to HLS thumbnail")
                     
-                    # FALLBACK: Use HLS thumbnail if frame extraction fails
-                    refreshed_asset = client.indexes.indexed_assets.retrieve(
-                        index_id=index.id,
-                        indexed_asset_id=indexed_asset.id
-                    )
+                    # FALLBACK: Use HLS thumbnail if frame extraction fails.
+                    # The poll loop's last response already carries hls, so
+                    # only cache hits (which skipped polling) re-fetch it
+                    if ready_asset is not None:
+                        refreshed_asset = ready_asset
+                    else:
+                        refreshed_asset = client.indexes.indexed_assets.retrieve(
+                            index_id=index_id,
+                            indexed_asset_id=indexed_asset_id
+                        )
                     
                     if hasattr(refreshed_asset, 'hls') and refreshed_asset.hls:
                         if hasattr(refreshed_asset.hls, 'thumbnail_urls') and refreshed_asset.hls.thumbnail_urls:
@@ -375,7 +616,7 @@ def search_media():
                                 screenshot_url = thumbnails[0]
                                 print(f"Using HLS thumbnail: {screenshot_url}")
                 
-                print(f"Final screenshot ready (base64: {len(screenshot_url) if screenshot_url else 0} chars)")
+                print(f"Final screenshot ready: {screenshot_url}")
             else:
                 print("No search results found.")
         except Exception as e:
@@ -383,11 +624,9 @@ def search_media():
             import traceback
             traceback.print_exc()
 
-        # Cleanup
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-        if frame_path and os.path.exists(frame_path):
-            os.remove(frame_path)
+        # Cleanup happens off the request thread so the response can go
+        # out immediately (the extracted frame stays cached until its TTL)
+        remove_file_later(temp_path)
 
         return jsonify({
             "status": "success",
@@ -397,14 +636,14 @@ def search_media():
         })
 
     except Exception as e:
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-        if frame_path and os.path.exists(frame_path):
-            os.remove(frame_path)
+        remove_file_later(temp_path)
         print(f"Error: {str(e)}")
         import traceback
         traceback.print_exc()
         return jsonify({"status": "error", "message": str(e)}), 500
 
 if __name__ == '__main__':
-    app.run(debug=True, host='127.0.0.1', port=8000)
\ No newline at end of file
+    # Local development only - in production run via wsgi.py under
+    # gunicorn (see that module for the command line). threaded=True lets
+    # one dev request sleep in the indexing poll loop while others proceed
+    app.run(debug=True, host='127.0.0.1', port=8000, threaded=True)
\ No newline at end of file
@@ -0,0 +1,15 @@
+"""WSGI entry point for running the API under a production server.
+
+The built-in Flask dev server (python app.py) is single-threaded and
+reloads on changes, so concurrent media-processing requests queue up
+behind each other. In production run:
+
+    gunicorn wsgi:app -k gthread -w 2 --threads 8 --timeout 600
+
+Threaded workers let requests overlap while others wait on TwelveLabs
+I/O, which is where this API spends most of its time.
+"""
+from app import app
+
+if __name__ == '__main__':
+    app.run(host='127.0.0.1', port=8000)